@@ -16,6 +16,11 @@ from picosdk.functions import assert_pico_ok
 # from picosdk.functions import assert_pico_ok as library_assert_pico_ok
 
 
+def to_volts(raw, scale, out=None):
+    # convert ADC counts to Volts in one vectorized pass, float32 result
+    return np.multiply(raw, np.float32(scale), out=out, dtype=np.float32)
+
+
 class PicoLog1000:
     # config_logger
     logger = logging.getLogger(__qualname__)
@@ -49,14 +54,22 @@ class PicoLog1000:
         self.trigger_auto = False
         self.trigger_ms = 1000
         #
+        self.buffer = None
         self.data = None
         self.times = None
         self.timeout = None
         self.overflow = 0
         self.trigger = 0
         self.info = {}
+        # driver output values reused for every call
+        self.ready_c = ctypes.c_int16(0)
+        self.ready_ref = ctypes.byref(self.ready_c)
+        self.overflow_c = ctypes.c_uint16()
+        self.trigger_c = ctypes.c_uint32()
+        self.points_c = ctypes.c_uint32()
         #
         self.recording_start_time = 0.0
+        self.recording_end_time = 0.0
         self.read_time = 0.0
         self.t0 = time.time()
         #
@@ -141,9 +154,12 @@ class PicoLog1000:
     def set_timing(self, channels, channel_points, channel_record_us):
         self.assert_open()
         nc = len(channels)
-        cnls = (ctypes.c_int16 * nc)()
-        for i in range(nc):
-            cnls[i] = channels[i]
+        cnls = (ctypes.c_int16 * nc)(*channels)
+        # driver takes 32 bit unsigned values, ctypes would silently truncate larger ones
+        if not 0 < channel_record_us < 2 ** 32:
+            raise ArgumentOutOfRangeError('PicoLog: channel record time %s us is out of range' % channel_record_us)
+        if not 0 < channel_points < 2 ** 32:
+            raise ArgumentOutOfRangeError('PicoLog: number of points %s is out of range' % channel_points)
         t_us = ctypes.c_uint32(channel_record_us)
         n = ctypes.c_uint32(channel_points)
         self.last_status = pl1000.pl1000SetInterval(self.handle, ctypes.byref(t_us),
@@ -161,14 +177,17 @@ class PicoLog1000:
         self.sampling = (0.001 * self.record_us) / self.points
         self.logger.debug('PicoLog: Timing: %s channels %s; sampling %s ms; %s points; duration %s us',
                           len(self.channels), self.channels, self.sampling, self.points, self.record_us)
-        # create array for data
-        self.data = np.empty((len(self.channels), self.points), dtype=np.uint16, order='F')
+        # create arrays for data, reuse existing ones if shape is the same
+        if self.data is None or self.data.shape != (len(self.channels), self.points):
+            # buffer for driver, samples are interleaved: point after point, channel after channel
+            self.buffer = np.empty((self.points, len(self.channels)), dtype=np.uint16)
+            # data array, C-contiguous rows per channel
+            self.data = np.empty((len(self.channels), self.points), dtype=np.uint16)
         # and timings
-        # fill timings array
+        # fill timings array, channels are sampled one after another within sampling interval
         self.t = np.linspace(0.0, (self.points - 1) * self.sampling, self.points, dtype=np.float32)
-        self.times = np.empty(self.data.shape, dtype=np.float32)
-        for i in range(len(self.channels)):
-            self.times[i, :] = self.t + (i * self.sampling / len(self.channels))
+        offsets = np.arange(len(self.channels), dtype=np.float32) * np.float32(self.sampling / len(self.channels))
+        self.times = self.t + offsets[:, np.newaxis]
         if self.points != channel_points or self.record_us != channel_record_us:
             return False
         return True
@@ -194,13 +213,15 @@ class PicoLog1000:
         self.last_status = pl1000.pl1000Run(self.handle, n, m)
         assert_pico_ok(self.last_status)
         self.recording_start_time = time.time()
+        # device can not be ready before the whole block has been recorded
+        self.recording_end_time = self.recording_start_time + 1.0e-6 * self.record_us * n.value / max(self.points, 1)
 
     def ready(self):
         self.assert_open()
-        ready = ctypes.c_int16(0)
-        self.last_status = pl1000.pl1000Ready(self.handle, ctypes.byref(ready))
+        self.ready_c.value = 0
+        self.last_status = pl1000.pl1000Ready(self.handle, self.ready_ref)
         assert_pico_ok(self.last_status)
-        return ready.value
+        return self.ready_c.value
 
     def wait_result(self, timeout=None):
         if timeout is None:
@@ -208,25 +229,38 @@ class PicoLog1000:
         if timeout is None:
             return self.ready()
         t0 = time.time()
-        while not self.ready():
+        # device can not be ready before the whole block has been recorded
+        time.sleep(max(0.0, min(self.recording_end_time - t0, timeout)))
+        self.assert_open()
+        # driver function is bound once for polling loop, status is checked after it
+        ready_function = pl1000.pl1000Ready
+        ok = pl1000.PICO_STATUS['PICO_OK']
+        self.ready_c.value = 0
+        while True:
+            self.last_status = ready_function(self.handle, self.ready_ref)
+            if self.ready_c.value or self.last_status != ok:
+                break
             if (time.time() - t0) > timeout:
                 return False
-        return self.ready()
+            time.sleep(0.001)
+        assert_pico_ok(self.last_status)
+        return self.ready_c.value
 
     def read(self, wait=0.0):
         if wait > 0.0:
             self.wait_result(wait)
         if not self.ready():
             self.logger.warning('PicoLog: read - device is not ready')
-        overflow = ctypes.c_uint16()
-        trigger = ctypes.c_uint32()
-        n = ctypes.c_uint32(self.points)
-        self.last_status = pl1000.pl1000GetValues(self.handle, self.data.ctypes, ctypes.byref(n),
-                                                  ctypes.byref(overflow), ctypes.byref(trigger))
+        n = self.points_c
+        n.value = self.points
+        self.last_status = pl1000.pl1000GetValues(self.handle, self.buffer.ctypes, ctypes.byref(n),
+                                                  ctypes.byref(self.overflow_c), ctypes.byref(self.trigger_c))
         assert_pico_ok(self.last_status)
+        # one transposing copy per shot, all channel reads are contiguous afterwards
+        self.data[...] = self.buffer.T
         self.read_time = time.time()
-        self.overflow = overflow.value
-        self.trigger = trigger.value
+        self.overflow = self.overflow_c.value
+        self.trigger = self.trigger_c.value
         if self.points != n.value:
             self.logger.warning('PicoLog: data partial reading %s of %s', n.value, self.points)
 
@@ -350,8 +384,9 @@ if __name__ == "__main__":
 
     import matplotlib.pyplot as plt
 
-    for i in range(len(pl.channels)):
-        plt.plot(pl.times[i, :], pl.data[i, :] * pl.scale * 1000)
+    mv = to_volts(pl.data, pl.scale * 1000)
+    # one call plots all channels, columns are channels
+    plt.plot(pl.times.T, mv.T)
     plt.xlabel('Time (ms)')
     plt.ylabel('Voltage (mV)')
     plt.legend([str(i) for i in pl.channels])
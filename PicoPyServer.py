@@ -6,6 +6,9 @@ PicoLog1000 series tango device server
 
 """
 import json
+import time
+import ctypes
+import logging
 import sys; sys.path.append('../TangoUtils')
 
 import numpy
@@ -15,9 +18,10 @@ from tango.server import attribute, command
 
 from TangoServerPrototype import TangoServerPrototype
 from log_exception import log_exception
+from picosdk.errors import ClosedDeviceError, PicoSDKCtypesError
+from picosdk.pl1000 import pl1000
 
-
-from PicoLog1000 import *
+from PicoLog1000 import PicoLog1000, to_volts
 
 
 def list_from_str(input_str):
@@ -32,11 +36,17 @@ def list_from_str(input_str):
         return []
 
 
+EMPTY_Y = numpy.zeros(0, dtype=numpy.uint16)
+EMPTY_Y.setflags(write=False)
+EMPTY_X = numpy.zeros(0, dtype=numpy.float32)
+EMPTY_X.setflags(write=False)
+
+
 def empty_array(xy='y'):
     if xy == 'y':
-        return numpy.zeros(0, dtype=numpy.uint16)
+        return EMPTY_Y
     else:
-        return numpy.zeros(0, dtype=np.float32)
+        return EMPTY_X
 
 
 def name_from_number(n: int, xy='y'):
@@ -46,6 +56,12 @@ def name_from_number(n: int, xy='y'):
 MAX_DATA_ARRAY_SIZE = 1000000
 MAX_ADC_VALUE = 4095
 MAX_ADC_CHANNELS = 16
+PING_CACHE_TIME = 1.0  # [s] ping result is reused during this time
+# errors raised by PicoLog driver calls
+PICOLOG_ERRORS = (PicoSDKCtypesError, ClosedDeviceError, ctypes.ArgumentError, OSError, AttributeError)
+# attribute names indexed by channel number, numbering starts from 1
+CHAN_Y_NAMES = tuple(name_from_number(i) for i in range(MAX_ADC_CHANNELS + 1))
+CHAN_X_NAMES = tuple(name_from_number(i, xy='x') for i in range(MAX_ADC_CHANNELS + 1))
 
 
 class PicoPyServer(TangoServerPrototype):
@@ -108,6 +124,12 @@ class PicoPyServer(TangoServerPrototype):
                            unit="", format="",
                            doc="Is data ready for reading")
 
+    shot_id = attribute(label="shot_id", dtype=int,
+                        display_level=DispLevel.OPERATOR,
+                        access=AttrWriteType.READ,
+                        unit="", format="%d",
+                        doc="Number of last recorded shot, incremented when new data is ready")
+
     channel_record_time_us = attribute(label="channel_record_time_us", dtype=int,
                                        min_value=0,
                                        display_level=DispLevel.OPERATOR,
@@ -445,6 +467,22 @@ class PicoPyServer(TangoServerPrototype):
                          unit="V", format="%f",
                          doc="Raw data from ADC for all channels. 16 bit integers, converted to Volts by display_units")
 
+    # raw data for all channels as one binary block
+    raw_encoded = attribute(label="raw_encoded", dtype=tango.DevEncoded,
+                            display_level=DispLevel.EXPERT,
+                            access=AttrWriteType.READ,
+                            doc='Raw data for all channels as bytes. '
+                                'Format is json string like {"dtype": "<u2", "shape": [2, 1000]}')
+
+    # data for all channels converted to Volts
+    volts = attribute(label="volts", dtype=[[numpy.float32]],
+                      max_dim_y=MAX_ADC_CHANNELS,
+                      max_dim_x=MAX_DATA_ARRAY_SIZE,
+                      display_level=DispLevel.OPERATOR,
+                      access=AttrWriteType.READ,
+                      unit="V", format="%f",
+                      doc="Data for all channels in Volts. 32 bit floats")
+
     # timings for all  channels 32-bit floats in ms
     times = attribute(label="times", dtype=[[numpy.float32]],
                       max_dim_y=MAX_ADC_CHANNELS,
@@ -458,13 +496,24 @@ class PicoPyServer(TangoServerPrototype):
     def init_device(self):
         self.picolog = None
         self.device_type_str = "Unknown PicoLog device"
+        self.info_str = '{}'
         self.device_name = ''
         self.record_initiated = False
         self.data_ready_value = False
+        # keep shot counting over reinitialization
+        self.shot_id_value = getattr(self, 'shot_id_value', 0)
+        self.volts_buffer = None
+        self.volts_valid = False
         self.init_result = None
         self.reconnect_enabled = False
         self.reconnect_timeout = time.time() + 5.0
         self.reconnect_count = 3
+        # last requested (channels, points, record_us) programmed to PicoLog
+        self.timing_request = None
+        # device property values written to database
+        self.saved_properties = {}
+        # last ping value and its expiration time
+        self.ping_cache = (-1.0, 0.0)
         # trigger
         self.trigger_enabled = 0
         self.trigger_auto = 0
@@ -474,12 +523,19 @@ class PicoPyServer(TangoServerPrototype):
         self.trigger_threshold = 2048
         self.trigger_hysteresis = 100
         self.trigger_delay = 10.0
+        # data attributes by name and channel attributes indexed by channel number
+        self.attributes_by_name = {name: getattr(self, name)
+                                   for name in CHAN_Y_NAMES[1:] + CHAN_X_NAMES[1:] + ('raw_data',)}
+        self.chany_attributes = [None] + [self.attributes_by_name[name] for name in CHAN_Y_NAMES[1:]]
+        self.chanx_attributes = [None] + [self.attributes_by_name[name] for name in CHAN_X_NAMES[1:]]
         # set logger and device proxy in super and then call self.set_config()
         super().init_device()
         if self not in PicoPyServer.device_list:
             PicoPyServer.device_list.append(self)
         self.log_level.set_write_value(logging.getLevelName(self.logger.getEffectiveLevel()))
         self.configure_tango_logging()
+        # raw_data change events are pushed manually once per shot
+        self.set_change_event('raw_data', True, False)
 
     def set_config(self):
         super().set_config()
@@ -497,6 +553,7 @@ class PicoPyServer(TangoServerPrototype):
             self.set_state(DevState.OPEN)
             self.set_status('PicoLog has been opened')
             self.picolog.get_info()
+            self.info_str = str(self.picolog.info)
             self.device_type_str = self.picolog.info['PICO_VARIANT_INFO']
             try:
                 self.max_channels = int(self.device_type_str[-2:])
@@ -513,8 +570,7 @@ class PicoPyServer(TangoServerPrototype):
             self.max_adc = 2 ** self.bits
             self.apply_config()
             self.init_result = None
-            msg = '%s %s has been initialized' % (self.device_name, self.device_type_str)
-            self.logger.info(msg)
+            self.logger.info('%s %s has been initialized', self.device_name, self.device_type_str)
             self.set_state(DevState.STANDBY)
             self.set_status('PicoLog has been initialized successfully')
         except Exception as ex:
@@ -542,23 +598,28 @@ class PicoPyServer(TangoServerPrototype):
         self.data_ready_value = False
         self.set_state(DevState.CLOSE)
         self.set_status('PicoLog has been deleted')
-        msg = '%s PicoLog has been deleted' % self.device_name
-        self.logger.info(msg)
+        self.logger.info('%s PicoLog has been deleted', self.device_name)
 
     def read_picolog_type(self):
         return self.device_type_str
 
     def read_info(self):
-        return str(self.picolog.info)
+        return self.info_str
 
     def read_ping(self):
+        now = time.monotonic()
+        v, expiration = self.ping_cache
+        if now < expiration:
+            return v
+        if self.picolog is None:
+            return -1.0
         try:
             v = self.picolog.ping()
+            if v >= 0.0:
+                self.ping_cache = (v, now + PING_CACHE_TIME)
             return v
-        except KeyboardInterrupt:
-            raise
-        except:
-            log_exception(self, '%s Ping error' % self.device_name, level=logging.INFO)
+        except PICOLOG_ERRORS:
+            log_exception(self, '%s Ping error', self.device_name, level=logging.INFO)
         self.reconnect()
         return -1.0
 
@@ -592,6 +653,9 @@ class PicoPyServer(TangoServerPrototype):
     def read_data_ready(self):
         return self.data_ready_value
 
+    def read_shot_id(self):
+        return self.shot_id_value
+
     def read_channel_record_time_us(self):
         return self.picolog.record_us
 
@@ -643,24 +707,26 @@ class PicoPyServer(TangoServerPrototype):
         return self.picolog.read_time
 
     def read_channel_data(self, channel: int, xy: str = 'y'):
-        channel_name = name_from_number(channel, xy)
-        if not hasattr(self, channel_name):
-            msg = '%s Read for unknown channel %s' % (self.device_name, channel_name)
-            self.logger.info(msg)
+        x = 'x' == xy[0].lower()
+        if not 0 < channel <= MAX_ADC_CHANNELS:
+            self.logger.info('%s Read for unknown channel %s', self.device_name, name_from_number(channel, xy))
             return empty_array(xy)
-        channel_attribute = getattr(self, channel_name)
+        if x:
+            channel_name = CHAN_X_NAMES[channel]
+            channel_attribute = self.chanx_attributes[channel]
+        else:
+            channel_name = CHAN_Y_NAMES[channel]
+            channel_attribute = self.chany_attributes[channel]
         if channel not in self.picolog.channels:
             channel_attribute.set_quality(AttrQuality.ATTR_INVALID)
-            msg = '%s Channel %s is not set for measurements' % (self.device_name, channel_name)
-            self.logger.info(msg)
+            self.logger.info('%s Channel %s is not set for measurements', self.device_name, channel_name)
             return empty_array(xy)
         if not self.read_data_ready():
             channel_attribute.set_quality(AttrQuality.ATTR_INVALID)
-            msg = '%s Data is not ready for %s' % (self.device_name, channel_name)
-            self.logger.info(msg)
+            self.logger.info('%s Data is not ready for %s', self.device_name, channel_name)
             return empty_array(xy)
         channel_index = self.picolog.channels.index(channel)
-        if 'x' == xy[0].lower():
+        if x:
             data = self.picolog.times[channel_index, :]
         else:
             data = self.picolog.data[channel_index, :]
@@ -772,9 +838,33 @@ class PicoPyServer(TangoServerPrototype):
             return self.picolog.data
         else:
             self.raw_data.set_quality(AttrQuality.ATTR_INVALID)
-            msg = '%s Data is not ready' % self.device_name
-            self.logger.warning(msg)
-            return numpy.zeros(0, dtype=numpy.uint16)
+            self.logger.warning('%s Data is not ready', self.device_name)
+            return EMPTY_Y
+
+    def read_raw_encoded(self):
+        if self.data_ready_value:
+            data = self.picolog.data
+            self.logger.debug('%s Reading raw_encoded %s', self.device_name, data.shape)
+            self.raw_encoded.set_quality(AttrQuality.ATTR_VALID)
+            return json.dumps({'dtype': data.dtype.str, 'shape': data.shape}), data.tobytes()
+        else:
+            self.raw_encoded.set_quality(AttrQuality.ATTR_INVALID)
+            self.logger.warning('%s Data is not ready', self.device_name)
+            return '', b''
+
+    def read_volts(self):
+        if self.data_ready_value:
+            # convert once per shot into preallocated buffer
+            if not self.volts_valid:
+                to_volts(self.picolog.data, self.picolog.scale, out=self.volts_buffer)
+                self.volts_valid = True
+            self.logger.debug('%s Reading volts %s', self.device_name, self.volts_buffer.shape)
+            self.volts.set_quality(AttrQuality.ATTR_VALID)
+            return self.volts_buffer
+        else:
+            self.volts.set_quality(AttrQuality.ATTR_INVALID)
+            self.logger.warning('%s Data is not ready', self.device_name)
+            return EMPTY_X
 
     def read_times(self):
         if self.data_ready_value:
@@ -783,18 +873,15 @@ class PicoPyServer(TangoServerPrototype):
             return self.picolog.times
         else:
             self.times.set_quality(AttrQuality.ATTR_INVALID)
-            msg = '%s Times array is not ready' % self.device_name
-            self.logger.warning(msg)
-            return numpy.zeros(0, dtype=numpy.uint16)
+            self.logger.warning('%s Times array is not ready', self.device_name)
+            return EMPTY_X
 
     @command(dtype_in=None, dtype_out=bool)
     def ready(self):
         self.assert_picolog_open()
         try:
             return self.picolog.ready()
-        except KeyboardInterrupt:
-            raise
-        except:
+        except PICOLOG_ERRORS:
             log_exception(self, '%s Readiness query error', self.device_name, level=logging.WARNING)
             return False
 
@@ -804,16 +891,14 @@ class PicoPyServer(TangoServerPrototype):
         try:
             if value > 0:
                 if self.record_initiated:
-                    msg = '%s Can not start - record in progress' % self.device_name
-                    self.logger.info(msg)
+                    self.logger.info('%s Can not start - record in progress', self.device_name)
                     return False
             self.picolog.start_recording()
             self.record_initiated = True
             self.data_ready_value = False
             self.set_state(DevState.RUNNING)
             self.set_status('Recording is in progress')
-            msg = '%s Recording started' % self.device_name
-            self.logger.info(msg)
+            self.logger.info('%s Recording started', self.device_name)
             return True
         except KeyboardInterrupt:
             raise
@@ -821,7 +906,7 @@ class PicoPyServer(TangoServerPrototype):
             self.record_initiated = False
             self.set_state(DevState.FAULT)
             self.set_status('Recording start fault')
-            log_exception(self, '%s Recording start error' % self.device_name, level=logging.WARNING)
+            log_exception(self, '%s Recording start error', self.device_name, level=logging.WARNING)
             return False
 
     @command(dtype_in=None, dtype_out=bool)
@@ -840,24 +925,23 @@ class PicoPyServer(TangoServerPrototype):
 
     @command(dtype_in=None)
     def stop_recording(self):
+        if not self.record_initiated and self.get_state() != DevState.RUNNING:
+            self.data_ready_value = False
+            return
         try:
             self.picolog.stop()
             self.set_state(DevState.STANDBY)
             self.set_status('Recording has been stopped')
-            self.logger.info('%s Recording has been stopped' % self.device_name)
+            self.logger.info('%s Recording has been stopped', self.device_name)
         except KeyboardInterrupt:
             raise
         except:
             self.set_state(DevState.FAULT)
             self.set_status('Recording stop error')
-            log_exception(self, '%s Recording stop error' % self.device_name, level=logging.WARNING)
+            log_exception(self, '%s Recording stop error', self.device_name, level=logging.WARNING)
         self.record_initiated = False
         self.data_ready_value = False
 
-    def assert_proxy(self):
-        if not hasattr(self, 'device_proxy') or self.device_proxy is None:
-            self.device_proxy = tango.DeviceProxy(self.device_name)
-
     def assert_picolog_open(self):
         if self.picolog.opened:
             if self.picolog.last_status == pl1000.PICO_STATUS['PICO_OK'] or \
@@ -880,9 +964,9 @@ class PicoPyServer(TangoServerPrototype):
         try:
             attrib = channel
             if isinstance(channel, int):
-                attrib = getattr(self, name_from_number(channel))
+                attrib = self.chany_attributes[channel]
             elif isinstance(channel, str):
-                attrib = getattr(self, str(channel))
+                attrib = self.attributes_by_name[channel]
             if props is None:
                 props = {}
             prop = attrib.get_properties()
@@ -903,11 +987,11 @@ class PicoPyServer(TangoServerPrototype):
             log_exception(self, 'Properties set error')
 
     def configure_channels(self):
-        for i in range(1, 17):
-            self.set_channel_properties(name_from_number(i))
-            self.set_channel_properties(name_from_number(i, xy='x'),
-                                        {'display_unit': 1.0,
-                                         'max_value': (self.picolog.points - 1) * self.picolog.sampling})
+        x_props = {'display_unit': 1.0,
+                   'max_value': (self.picolog.points - 1) * self.picolog.sampling}
+        for i in range(1, MAX_ADC_CHANNELS + 1):
+            self.set_channel_properties(self.chany_attributes[i])
+            self.set_channel_properties(self.chanx_attributes[i], x_props)
         self.set_channel_properties(self.raw_data)
         self.channel_record_time_us.set_write_value(self.config['channel_record_time_us'])
         self.points_per_channel.set_write_value(self.config['points_per_channel'])
@@ -919,12 +1003,23 @@ class PicoPyServer(TangoServerPrototype):
         channels_list = list_from_str(self.config.get('channels', '[1]'))
         points = int(self.config.get('points_per_channel', 1000))
         record_us = int(self.config.get('channel_record_time_us', MAX_DATA_ARRAY_SIZE))
+        timing = (channels_list, points, record_us)
+        if timing == self.timing_request and self.picolog.data is not None:
+            return
         self.picolog.set_timing(channels_list, points, record_us)
+        # store driver corrected values, they are written to config below
+        self.timing_request = (channels_list, self.picolog.points, self.picolog.record_us)
         self.data_ready_value = False
+        if self.volts_buffer is None or self.volts_buffer.shape != self.picolog.data.shape:
+            self.volts_buffer = numpy.empty(self.picolog.data.shape, dtype=numpy.float32)
+        self.volts_valid = False
         self.config['points_per_channel'] = self.picolog.points
-        self.set_device_property('points_per_channel', str(self.config['points_per_channel']))
         self.config['channel_record_time_us'] = self.picolog.record_us
-        self.set_device_property('channel_record_time_us', str(self.config['channel_record_time_us']))
+        for prop in ('points_per_channel', 'channel_record_time_us'):
+            value = str(self.config[prop])
+            if self.saved_properties.get(prop) != value:
+                self.set_device_property(prop, value)
+                self.saved_properties[prop] = value
 
     def set_trigger(self):
         self.assert_picolog_open()
@@ -951,17 +1046,28 @@ class PicoPyServer(TangoServerPrototype):
             if self.picolog.ready():
                 self.picolog.read()
                 self.record_initiated = False
+                self.volts_valid = False
+                self.shot_id_value += 1
                 self.data_ready_value = True
-                self.logger.info('%s Data has been red' % self.device_name)
+                self.logger.info('%s Recording finished, data has been read', self.device_name)
                 self.set_state(DevState.STANDBY)
                 self.set_status('Data is ready')
+                self.push_data_event()
         except KeyboardInterrupt:
             raise
         except:
             self.record_initiated = False
             self.set_state(DevState.Fault)
             self.set_status('Data read error')
-            log_exception(self, '%s Reading data error' % self.device_name, level=logging.WARNING)
+            log_exception(self, '%s Reading data error', self.device_name, level=logging.WARNING)
+
+    def push_data_event(self):
+        try:
+            self.push_change_event('raw_data', self.picolog.data)
+        except KeyboardInterrupt:
+            raise
+        except:
+            log_exception(self, '%s raw_data event push error', self.device_name, level=logging.WARNING)
 
     def reconnect(self):
         if not self.reconnect_enabled:
@@ -990,20 +1096,20 @@ def looping():
     global t0
     time.sleep(0.010)
     for dev in PicoPyServer.device_list:
-        time.sleep(0.001)
         if time.time() - t0 > 1.0:
             t0 = time.time()
             dev.assert_picolog_open()
         if dev.record_initiated:
+            # do not poll driver before recording time has elapsed
+            if time.time() < dev.picolog.recording_end_time:
+                continue
             try:
                 if dev.ready():
-                    msg = '%s Recording finished, data is ready' % dev.device_name
-                    dev.logger.info(msg)
                     dev.read()
             except KeyboardInterrupt:
                 raise
             except:
-                log_exception(dev, '%s Reading data error' % dev.device_name, level=logging.WARNING)
+                log_exception(dev, '%s Reading data error', dev.device_name, level=logging.WARNING)
         # if not dev.tango_logging:
         #     dev.configure_tango_logging()
     # PicoPyServer.logger.debug('loop end')